@@ -1,72 +1,192 @@
+import hashlib
+import os
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import seaborn as sns
 import matplotlib.pyplot as plt
 from pathlib import Path
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to the NumPy kernel below
+    njit = None
+
 # Constants
 DATA_FOLDER = Path.cwd()
 REQUIRED_COLUMNS = {"component", "sub-component", "variable", "measure", "country", "iso code", "year", "value"}
+# Low-cardinality text, parsed straight into dictionary (pandas category) columns
+CATEGORY_COLUMNS = {"component", "sub-component", "variable", "measure", "country", "iso code"}
+# Bump whenever load_all_data's output changes, so caches written by older code are ignored
+LOADER_VERSION = 1
+CACHE_PREFIX = "hsil_heatmap_cache_"
+
+def _coerce_numeric(column):
+    # Some exports leak stray text into the value column; mirror pd.to_numeric(errors="coerce")
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type) or pa.types.is_null(column.type):
+        return column
+    return pa.array(pd.to_numeric(column.to_pandas(), errors="coerce"), type=pa.float64())
+
+def _coerce_year(column):
+    # Same coercion as value, then null out anything that isn't a whole year int16 can hold
+    years = _coerce_numeric(column).cast(pa.float64())
+    valid = pc.and_(pc.equal(years, pc.floor(years)), pc.less_equal(pc.abs(years), 32767))
+    return pc.if_else(valid, years, pa.scalar(None, pa.float64())).cast(pa.int16())
+
+def _group_mean_2d_loop(rows, cols, values, n_rows, n_cols):
+    # Serial on purpose: a prange over scattered += into the same cells would race
+    total = np.zeros((n_rows, n_cols))
+    count = np.zeros((n_rows, n_cols), np.int64)
+    for i in range(values.shape[0]):
+        if not np.isnan(values[i]):
+            total[rows[i], cols[i]] += values[i]
+            count[rows[i], cols[i]] += 1
+    out = np.full((n_rows, n_cols), np.nan)
+    for r in range(n_rows):
+        for c in range(n_cols):
+            if count[r, c] > 0:
+                out[r, c] = total[r, c] / count[r, c]
+    return out
+
+def _group_mean_2d_numpy(rows, cols, values, n_rows, n_cols):
+    valid = ~np.isnan(values)
+    flat = rows[valid] * n_cols + cols[valid]
+    total = np.bincount(flat, weights=values[valid], minlength=n_rows * n_cols)
+    count = np.bincount(flat, minlength=n_rows * n_cols)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = np.where(count > 0, total / count, np.nan)
+    return out.reshape(n_rows, n_cols)
+
+# Mean of values per (row code, col code) cell, NaN where a cell has no observations.
+# The numba kernel is compiled on first use and cached on disk for later runs.
+_group_mean_2d = njit(cache=True)(_group_mean_2d_loop) if njit is not None else _group_mean_2d_numpy
+
+def _cache_path(files):
+    # Keyed on the loader version plus file names + mtimes, so touching or adding a CSV invalidates the cache
+    stamp = (LOADER_VERSION, sorted((f.name, f.stat().st_mtime_ns) for f in files))
+    sig = hashlib.sha1(repr(stamp).encode()).hexdigest()[:12]
+    return DATA_FOLDER / f"{CACHE_PREFIX}{sig}.feather"
 
 def load_all_data():
-    combined_df = []
+    files = sorted(DATA_FOLDER.glob("*_Dataset_New_Taxonomy.csv"))
+    cache_path = _cache_path(files)
+    if cache_path.exists():
+        try:
+            df = pd.read_feather(cache_path)
+            print(f"📦 Loaded cached datasets from {cache_path.name}")
+            return df
+        except Exception as e:
+            print(f"⚠️ Discarding unreadable cache {cache_path.name}: {e}")
+            cache_path.unlink(missing_ok=True)
+
+    tables = []
+    complete = True  # only a load where every file made it is worth caching
     print("📥 Loading datasets...")
     
-    for file in DATA_FOLDER.glob("*_Dataset_New_Taxonomy.csv"):
+    for file in files:
         try:
-            df = pd.read_csv(file)
-            df.columns = [col.strip().lower() for col in df.columns]
+            # Screen on the header row alone; only conforming files get their body parsed
+            header = list(pd.read_csv(file, nrows=0).columns)
+            columns = [col.strip().lower() for col in header]
 
             # Normalize possible variant of 'value' column
-            if 'val' in df.columns and 'value' not in df.columns:
-                df.rename(columns={'val': 'value'}, inplace=True)
+            if 'val' in columns and 'value' not in columns:
+                columns[columns.index('val')] = 'value'
 
-            if REQUIRED_COLUMNS.issubset(set(df.columns)):
-                combined_df.append(df)
+            if REQUIRED_COLUMNS.issubset(set(columns)):
+                keep = [(orig, col) for orig, col in zip(header, columns) if col in REQUIRED_COLUMNS]
+                tbl = pacsv.read_csv(
+                    file,
+                    read_options=pacsv.ReadOptions(use_threads=True),
+                    convert_options=pacsv.ConvertOptions(
+                        include_columns=[orig for orig, _ in keep],
+                        column_types={orig: pa.dictionary(pa.int32(), pa.string()) for orig, col in keep if col in CATEGORY_COLUMNS},
+                        # Blank text cells are missing values (NaN in pandas), not "" categories
+                        strings_can_be_null=True
+                    )
+                )
+                tbl = tbl.rename_columns([col for _, col in keep])
+                # Narrow numerics: years fit in int16 and float32 is plenty for the plotted values
+                tbl = tbl.set_column(tbl.schema.get_field_index("value"), "value", _coerce_numeric(tbl.column("value")).cast(pa.float32()))
+                tbl = tbl.set_column(tbl.schema.get_field_index("year"), "year", _coerce_year(tbl.column("year")))
+                tables.append(tbl)
                 print(f"✅ Loaded: {file.name}")
             else:
-                missing = REQUIRED_COLUMNS - set(df.columns)
+                missing = REQUIRED_COLUMNS - set(columns)
                 print(f"⚠️ Skipped {file.name}: missing columns {missing}")
+                complete = False
         except Exception as e:
             print(f"❌ Error loading {file.name}: {e}")
+            complete = False
     
-    if combined_df:
-        return pd.concat(combined_df, ignore_index=True)
+    if tables:
+        # One Arrow concat and a single conversion, instead of a pandas frame per file plus a concat copy
+        # Nullable Int16 keeps year narrow even where it has gaps (plain int16 would become float64)
+        df = pa.concat_tables(tables, promote_options="permissive").to_pandas(types_mapper={pa.int16(): pd.Int16Dtype()}.get)
+        # Categories come out in first-seen order; sort them so code order is alphabetical
+        for col in CATEGORY_COLUMNS:
+            df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+
+        if complete:
+            # Write to a temp name and swap it in, so an interrupted write never leaves a truncated cache
+            tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+            try:
+                # only ever our own caches: DATA_FOLDER is the cwd and may hold anything
+                for stale in DATA_FOLDER.glob(f"{CACHE_PREFIX}*.feather*"):
+                    stale.unlink()
+                df.to_feather(tmp_path)
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                tmp_path.unlink(missing_ok=True)
+                print(f"⚠️ Could not write cache {cache_path.name}: {e}")
+        return df
     else:
         print("❌ No valid data loaded. Exiting.")
         return pd.DataFrame()
 
 def plot_bivariate_heatmap(df, var_x, var_y):
-    df_filtered = df[df["variable"].isin([var_x, var_y])].copy()
-    
-    # Check numeric conversion
-    df_filtered["value"] = pd.to_numeric(df_filtered["value"], errors="coerce")
+    # Match on the category codes rather than comparing every string
+    codes = df["variable"].cat.categories.get_indexer([var_x, var_y])
+    mask = np.isin(df["variable"].cat.codes.to_numpy(), codes[codes >= 0])
+    # value is already numeric (float32, stray text coerced to NaN) from load_all_data
+    df_filtered = df.loc[mask, ["country", "year", "variable", "value"]]
 
     # Report non-null count
-    non_null_counts = df_filtered.dropna(subset=["value"]).groupby("variable")["value"].count()
+    non_null_counts = df_filtered.dropna(subset=["value"]).groupby("variable", observed=True)["value"].count()
     print("\n📊 Non-null Value Count per Variable:")
     print(non_null_counts)
 
-    # Pivot
-    df_pivot = df_filtered.pivot_table(
-        index=["country", "year"],
-        columns="variable",
-        values="value",
-        aggfunc="mean"
-    ).reset_index()
+    # Dense (country x year) mean grids on factorized codes -- no pandas groupby/pivot machinery
+    c_codes, countries = pd.factorize(df_filtered["country"], sort=True)
+    y_codes, years = pd.factorize(df_filtered["year"], sort=True)
+    values = df_filtered["value"].to_numpy(np.float64)
+    keyed = (c_codes >= 0) & (y_codes >= 0)
+
+    grids = {}
+    for var in (var_x, var_y):
+        rows = keyed & (df_filtered["variable"] == var).to_numpy()
+        grids[var] = _group_mean_2d(c_codes[rows], y_codes[rows], values[rows], len(countries), len(years))
 
-    if var_x not in df_pivot.columns or var_y not in df_pivot.columns:
+    if np.isnan(grids[var_x]).all() or np.isnan(grids[var_y]).all():
         print("\n❌ One or both selected variables are not present in the data after pivoting.")
         return
 
-    df_bivar = df_pivot[["country", "year", var_x, var_y]].dropna()
+    # Keep only (country, year) cells observed for both variables
+    paired = ~np.isnan(grids[var_x]) & ~np.isnan(grids[var_y])
     
     # Filter to most common countries
-    top_countries = df_bivar["country"].value_counts().nlargest(15).index
-    df_bivar = df_bivar[df_bivar["country"].isin(top_countries)]
+    pair_counts = pd.Series(paired.sum(axis=1), index=countries)
+    top_countries = pair_counts[pair_counts > 0].nlargest(15).index
+    top = countries.isin(top_countries)
 
     # Create pivot for heatmap
-    heatmap_data = df_bivar.pivot(index="country", columns="year", values=var_y)
+    heatmap_data = pd.DataFrame(
+        np.where(paired[top], grids[var_y][top], np.nan),
+        index=pd.Index(countries[top], name="country"),
+        columns=pd.Index(years, name="year")
+    ).dropna(axis=1, how="all")
 
     # Plot
     plt.figure(figsize=(12, 8))
@@ -84,17 +204,26 @@ def plot_bivariate_heatmap(df, var_x, var_y):
     plt.tight_layout()
     plt.show()
 
+def prompt_variable(prompt, options):
+    # Pick by list number: free-typed names silently missed variants like "GDP " (trailing space)
+    while True:
+        choice = input(prompt).strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(options):
+            return options[int(choice) - 1]
+        print(f"⚠️ Enter a number between 1 and {len(options)}.")
+
 # Load data
 df_all = load_all_data()
 
 # Run if valid data loaded
 if not df_all.empty:
-    available_vars = sorted(df_all["variable"].dropna().unique())
+    # Categories are already sorted and NaN-free; no scan over the rows needed
+    available_vars = list(df_all["variable"].cat.categories)
     print("\n📌 Available Variables:")
     for i, var in enumerate(available_vars, 1):
         print(f"{i}. {var}")
 
-    var_x = input("\nEnter Variable X: ").strip()
-    var_y = input("Enter Variable Y: ").strip()
+    var_x = prompt_variable("\nEnter Variable X number: ", available_vars)
+    var_y = prompt_variable("Enter Variable Y number: ", available_vars)
 
     plot_bivariate_heatmap(df_all, var_x, var_y)
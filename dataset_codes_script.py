@@ -1,8 +1,20 @@
 # oecd_discover_codes.py (fixed for the new OECD SDMX API)
 import csv, io, json, os, time, urllib.request, xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lxml import etree as XML  # libxml2 parser, several times faster on dataflow/all
+except ImportError:
+    XML = ET
+
+try:
+    import orjson  # native encoder; stdlib json with indent= runs its pure-Python encoder
+except ImportError:
+    orjson = None
 
 BASE = "https://sdmx.oecd.org/public/rest"
 OUTDIR = "oecd_codelists"
+MAX_CONCURRENT = 4  # structure requests in flight at once; keeps the load on the API polite
 os.makedirs(OUTDIR, exist_ok=True)
 
 DEFAULT_HEADERS = {
@@ -25,10 +37,17 @@ def get(url, accept=None):
         body = r.read()
     return body, ctype
 
+def english_name(nm, fallback):
+    """Pick the English label from a multilingual dict, a list of {value, lang}, or a plain string."""
+    if isinstance(nm, dict):
+        return nm.get("en") or next(iter(nm.values()), None)
+    if isinstance(nm, list):
+        return next((n.get("value") for n in nm if isinstance(n, dict) and n.get("lang") == "en"), None) or str(nm)
+    return nm or fallback
+
 def parse_dataflow_json(payload):
     """Parse SDMX-Structure JSON dataflow/all into a list of dicts."""
     obj = json.loads(payload.decode("utf-8"))
-    flows = []
 
     # SDMX-JSON structure often nests under 'dataflows' -> 'dataflow'
     # Shapes differ; handle common variants
@@ -39,42 +58,60 @@ def parse_dataflow_json(payload):
         df = obj["structure"].get("dataflows") or obj["structure"].get("dataflow")
 
     if isinstance(df, dict):
-        items = df.values()
+        items = list(df.values())
     elif isinstance(df, list):
         items = df
     else:
         items = []
+    if not items:
+        return []
 
-    for item in items:
-        # Common fields across SDMX implementations
-        fid = item.get("id") or item.get("ID") or item.get("name")
-        agency = item.get("agencyID") or item.get("agencyId") or item.get("agency")
-        version = item.get("version") or ""
-        name = None
-        # Names can be multilingual dicts or strings
-        nm = item.get("name") or item.get("Name")
-        if isinstance(nm, dict):
-            name = nm.get("en") or next(iter(nm.values()), None)
-        elif isinstance(nm, list):
-            # list of {value, lang}
-            name = next((n.get("value") for n in nm if isinstance(n, dict) and n.get("lang") == "en"), None) or str(nm)
-        else:
-            name = nm or fid
-        if fid and agency:
-            flows.append({"id": fid, "agency": agency, "version": version, "title": name})
-    return flows
+    # A response uses a single item shape, so resolve the field names once from the
+    # first item (by presence, so an empty value still names the field) rather than
+    # trying every spelling on every dataflow; items that don't fit fall back to that
+    id_keys, agency_keys, name_keys = ("id", "ID", "name"), ("agencyID", "agencyId", "agency"), ("name", "Name")
+    first = items[0]
+    id_key = next((k for k in id_keys[:2] if k in first), "id")  # "name" is only ever a per-item last resort
+    agency_key = next((k for k in agency_keys if k in first), "agencyID")
+    name_key = next((k for k in name_keys if k in first), "name")
+
+    def field(item, key, keys):
+        return item.get(key) or next((item[k] for k in keys if item.get(k)), None)
+
+    return [
+        {"id": fid, "agency": agency, "version": item.get("version") or "", "title": english_name(field(item, name_key, name_keys), fid)}
+        for item in items
+        if (fid := field(item, id_key, id_keys)) and (agency := field(item, agency_key, agency_keys))
+    ]
+
+# Namespaces commonly used by SDMX 2.1 structure messages
+NS = {
+    "message": "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message",
+    "str": "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure",
+    "com": "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common",
+}
+DATAFLOW_TAG = f"{{{NS['str']}}}Dataflow"
+
+def iter_dataflows(payload):
+    """Stream the Dataflow elements of an SDMX-Structure document, freeing each once the caller is done with it."""
+    if XML is ET:
+        # ElementTree has no tag filter or sibling links; clearing each element is the best it offers
+        for _, df in XML.iterparse(io.BytesIO(payload), events=("end",)):
+            if df.tag == DATAFLOW_TAG:
+                yield df
+                df.clear()
+        return
+    for _, df in XML.iterparse(io.BytesIO(payload), events=("end",), tag=DATAFLOW_TAG):
+        yield df
+        df.clear()
+        # cleared elements still hang off their parent; drop the processed ones too
+        while df.getprevious() is not None:
+            del df.getparent()[0]
 
 def parse_dataflow_xml(payload):
     """Parse SDMX-Structure XML dataflow/all into a list of dicts."""
-    # Namespaces commonly used by SDMX 2.1 structure messages
-    NS = {
-        "message": "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message",
-        "str": "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure",
-        "com": "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common",
-    }
-    root = ET.fromstring(payload)
     flows = []
-    for df in root.findall(".//str:Dataflow", NS):
+    for df in iter_dataflows(payload):
         fid = df.get("id")
         agency = df.get("agencyID") or df.get("agencyId") or df.get("agency")
         version = df.get("version") or ""
@@ -129,26 +166,49 @@ def fetch_structure(agency, dataflow_id, version=""):
         raise RuntimeError(f"structure fetch failed: {e}")
 
 def save_json(path, obj):
+    # orjson output is equivalent JSON, not byte-identical to json.dump: floats are
+    # spelled 1e20 (not 1e+20) and NaN/Infinity become null
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            data = None  # e.g. integers beyond 64 bits, which json.loads happily produces
+        if data is not None:
+            with open(path, "wb") as f:
+                f.write(data)
+            return
     with open(path, "w", encoding="utf-8") as f:
         json.dump(obj, f, ensure_ascii=False, indent=2)
 
+def save_structure(i, total, f):
+    dsid = f["id"]; agency = f["agency"]; ver = f["version"]
+    title = f.get("title", dsid)
+    try:
+        print(f"[{i+1}/{total}] {agency}:{dsid} (v{ver or 'latest'}) – {title} …")
+        struct = fetch_structure(agency, dsid, ver)
+        # Save either JSON structure or raw XML (wrapped)
+        out_path = os.path.join(OUTDIR, f"{agency}_{dsid}_{ver or 'latest'}.structure.json")
+        save_json(out_path, struct)
+        time.sleep(0.3)  # gentle throttle (per worker)
+    except Exception as e:
+        print(f"Failed {agency}:{dsid}: {e}")
+
 def main():
     flows = list_dataflows()
     print(f"Found {len(flows)} dataflows. Writing to {OUTDIR}/index.json …")
     save_json(os.path.join(OUTDIR, "index.json"), flows)
 
-    for i, f in enumerate(sorted(flows, key=lambda x: (x['agency'], x['id']))):
-        dsid = f["id"]; agency = f["agency"]; ver = f["version"]
-        title = f.get("title", dsid)
-        try:
-            print(f"[{i+1}/{len(flows)}] {agency}:{dsid} (v{ver or 'latest'}) – {title} …")
-            struct = fetch_structure(agency, dsid, ver)
-            # Save either JSON structure or raw XML (wrapped)
-            out_path = os.path.join(OUTDIR, f"{agency}_{dsid}_{ver or 'latest'}.structure.json")
-            save_json(out_path, struct)
-            time.sleep(0.3)  # gentle throttle
-        except Exception as e:
-            print(f"Failed {agency}:{dsid}: {e}")
+    # Structure fetches are independent; overlap up to MAX_CONCURRENT of them
+    ordered = sorted(flows, key=lambda x: (x['agency'], x['id']))
+    pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT)
+    try:
+        for i, f in enumerate(ordered):
+            pool.submit(save_structure, i, len(ordered), f)
+        pool.shutdown(wait=True)
+    except KeyboardInterrupt:
+        # Ctrl-C: drop the queued flows instead of draining them; only in-flight fetches finish
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
 
 if __name__ == "__main__":
     main()
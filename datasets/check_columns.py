@@ -5,8 +5,9 @@ DATA_FOLDER = Path.cwd()
 
 for file in DATA_FOLDER.glob("*_Dataset_New_Taxonomy.csv"):
     try:
-        df = pd.read_csv(file)
+        # Header row only; the body isn't needed to list columns
+        cols = pd.read_csv(file, nrows=0).columns
         print(f"\n📄 {file.name} Columns:")
-        print(list(df.columns))
+        print(list(cols))
     except Exception as e:
         print(f"❌ Could not read {file.name}: {e}")
@@ -1,11 +1,30 @@
 # handler.py
-import os, io, json, gzip, csv, hashlib, time, urllib.request, urllib.error
+import os, json, zlib, csv, base64, hashlib, secrets, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import boto3
+import urllib3
 
 S3 = boto3.client("s3")
 DDB = boto3.resource("dynamodb")
 
+# Shared keep-alive pool (urllib3 ships with botocore): repeated OECD calls reuse
+# TCP/TLS connections, and Retry handles the transient statuses with backoff.
+# total=2 retries -> 3 tries per URL; the pool holds one connection per worker.
+MAX_POOL = 16  # upper bound on MAX_WORKERS
+HTTP = urllib3.PoolManager(
+    maxsize=MAX_POOL,
+    retries=urllib3.Retry(total=2, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504]),
+    headers={"User-Agent": "Lambda-OECD-Ingest/1.0"}
+)
+
+CHUNK_SIZE = 1 << 20  # read size when streaming OECD responses
+PART_SIZE = 5 << 20   # S3 minimum size for every multipart part except the last
+# Each worker peaks at about 2 x PART_SIZE (a full part plus the next one filling),
+# so a safe MAX_WORKERS is roughly free memory / (2 * PART_SIZE); see default_workers.
+RUNTIME_MB = 80       # resident size of Python + boto3 before any body is read
+BATCH_RETRIES = 8     # resends of DynamoDB UnprocessedKeys before giving up
+
 # ---------- Helper: env ----------
 def getenv(name, default=None, required=False):
     val = os.getenv(name, default)
@@ -13,6 +32,13 @@ def getenv(name, default=None, required=False):
         raise RuntimeError(f"Missing required env var: {name}")
     return val
 
+def default_workers():
+    """MAX_WORKERS default: as many workers as fit in the Lambda's memory, 8 outside Lambda."""
+    memory_mb = getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if not memory_mb:
+        return 8
+    return max(1, (int(memory_mb) - RUNTIME_MB) // (2 * PART_SIZE >> 20))  # e.g. 128 MB -> 4
+
 # ---------- OECD fetch ----------
 def build_oecd_urls(dataset_id: str, key_path: str, last_n_obs: int, fmt: str):
     """
@@ -40,100 +66,276 @@ def build_oecd_urls(dataset_id: str, key_path: str, last_n_obs: int, fmt: str):
 
     return [url_lastN, url_start]
 
-def http_get(url, retries=3, timeout=60):
-    last_err = None
-    for attempt in range(1, retries + 1):
-        try:
-            req = urllib.request.Request(url, headers={"User-Agent": "Lambda-OECD-Ingest/1.0"})
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                return resp.read()
-        except urllib.error.HTTPError as e:
-            # 404/400 may mean that parameter not supported; we allow fallback
-            last_err = e
-            if e.code in (429, 500, 502, 503, 504):
-                time.sleep(2 * attempt)
-            else:
-                break
-        except Exception as e:
-            last_err = e
-            time.sleep(2 * attempt)
-    raise last_err
+def http_get(url, timeout=60):
+    """GET url on the shared pool and return the live response; the caller reads and releases it."""
+    resp = HTTP.request("GET", url, timeout=timeout, preload_content=False)
+    if resp.status >= 400:
+        # 404/400 may mean that parameter not supported; we allow fallback
+        resp.drain_conn()
+        resp.release_conn()
+        raise RuntimeError(f"HTTP {resp.status} from {url[:120]}")
+    return resp
+
+def iter_body(resp, first: bytearray):
+    try:
+        yield first
+        del first  # the consumer owns it now; don't pin it for the rest of the stream
+        while chunk := resp.read(CHUNK_SIZE):
+            yield chunk
+    except BaseException:
+        # abandoned mid-body: the connection can't be reused
+        resp.close()
+        raise
+    resp.release_conn()
 
 def fetch_oecd(dataset_id: str, key_path: str, last_n_obs: int, fmt: str):
+    """
+    Return (chunks, url): an iterator over the response body and the URL that served it.
+
+    The first PART_SIZE bytes are read here, before anything is uploaded, so a
+    read timeout or reset within them falls back to the next URL like an HTTP
+    error does. Smaller bodies are therefore read in full by this point.
+    """
     urls = build_oecd_urls(dataset_id, key_path, last_n_obs, fmt)
     err_acc = []
     for url in urls:
         try:
-            blob = http_get(url)
+            resp = http_get(url)
+            head = bytearray()
+            try:
+                while len(head) < PART_SIZE and (chunk := resp.read(CHUNK_SIZE)):
+                    head += chunk
+            except Exception:
+                resp.close()
+                raise
             # sanity check non-empty
-            if not blob or len(blob) < 32:
+            if len(head) < 32:
+                resp.release_conn()
                 err_acc.append(f"Empty/short response from {url[:120]}")
                 continue
-            return blob, url
+            return iter_body(resp, head), url
         except Exception as e:
             err_acc.append(f"{type(e).__name__}: {e}")
     raise RuntimeError(f"All OECD fetch attempts failed for {dataset_id}/{key_path}: " + " | ".join(err_acc))
 
 # ---------- Storage + de-dupe ----------
-def sha256(data: bytes) -> str:
-    return hashlib.sha256(data).hexdigest()
+def deflate(gz, data) -> bytearray:
+    # feed zlib a CHUNK_SIZE slice at a time: one compress() over a whole part
+    # over-allocates its output buffer and briefly holds far more than the result
+    out = bytearray()
+    view = memoryview(data)
+    for i in range(0, len(view), CHUNK_SIZE):
+        out += gz.compress(view[i:i + CHUNK_SIZE])
+    return out
 
-def maybe_compress(data: bytes, do_gzip: bool) -> tuple[bytes, dict]:
-    headers = {}
+def maybe_compress(data: bytearray, do_gzip: bool) -> tuple[bytearray, dict]:
     if do_gzip:
-        out = io.BytesIO()
-        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as gz:
-            gz.write(data)
-        return out.getvalue(), {"ContentEncoding": "gzip"}
-    return data, headers
-
-def put_if_new(dataset_id: str, url_used: str, raw: bytes, s3_bucket: str, s3_prefix: str,
-               fmt: str, gzip_output: bool, ddb_table_name: str | None):
-    content_hash = sha256(raw)
+        gz = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+        out = deflate(gz, data)
+        out += gz.flush()
+        return out, {"ContentEncoding": "gzip"}
+    return data, {}
+
+def upload_part(upload: dict, data: bytearray):
+    # botocore accepts the bytearray as-is; no need for a bytes() copy of the part
+    part_number = len(upload["Parts"]) + 1
+    resp = S3.upload_part(Bucket=upload["Bucket"], Key=upload["Key"], UploadId=upload["UploadId"],
+                          PartNumber=part_number, Body=data)
+    upload["Parts"].append({"PartNumber": part_number, "ETag": resp["ETag"]})
+
+def load_last_hashes(table_name: str, datasets: list[str]) -> dict:
+    """
+    Prefetch the stored last_hash of every dataset with BatchGetItem
+    (one request per 100 keys instead of a get_item per dataset).
+    Partition key is 'dataset' (string).
+    """
+    keys = [{"dataset": ds} for ds in dict.fromkeys(datasets)]
+    prior = {}
+    for i in range(0, len(keys), 100):
+        request = {table_name: {
+            "Keys": keys[i:i + 100],
+            "ProjectionExpression": "#ds, last_hash",
+            "ExpressionAttributeNames": {"#ds": "dataset"}
+        }}
+        for attempt in range(BATCH_RETRIES + 1):
+            if attempt:
+                # throttled keys come back as UnprocessedKeys; back off exponentially before resending
+                time.sleep(min(0.05 * 2 ** attempt, 5))
+            resp = DDB.batch_get_item(RequestItems=request)
+            for item in resp.get("Responses", {}).get(table_name, []):
+                prior[item["dataset"]] = item.get("last_hash")
+            request = resp.get("UnprocessedKeys")
+            if not request:
+                break
+        else:
+            raise RuntimeError(f"DynamoDB left keys unprocessed after {BATCH_RETRIES} retries")
+    return prior
+
+def save_last_hashes(table_name: str, items: list[dict]):
+    # batch_writer groups puts into BatchWriteItem calls and retries unprocessed items
+    with DDB.Table(table_name).batch_writer(overwrite_by_pkeys=["dataset"]) as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+def put_if_new(dataset_id: str, url_used: str, chunks, s3_bucket: str, s3_prefix: str,
+               fmt: str, gzip_output: bool, prior_hashes: dict | None, ddb_updates: list):
+    """
+    Stream chunks to S3, hashing and (optionally) gzipping on the fly so
+    at most about two PART_SIZE buffers are held at a time.
+
+    Bodies under PART_SIZE are kept raw until the dedupe verdict, so an
+    unchanged payload is never compressed; new ones are gzipped in one go and
+    stored with a single put_object. Larger bodies are compressed as they
+    stream. With dedupe on, the compressed output is spilled to a temp file
+    (/tmp on Lambda, which must fit the largest compressed body) instead of
+    being uploaded, because the final key, the sha256 metadata and whether to
+    store anything at all are only known once the stream ends: an unchanged
+    body costs no S3 calls, and a new one is then sent from the file as a
+    multipart upload straight to its final key. With dedupe off nothing is
+    hashed here: the key gets a random suffix instead, multipart parts go out
+    as they fill, and single puts report the SHA-256 checksum S3 verified for
+    the stored object as s3_checksum_sha256 ("hash" is always the sha256 of
+    the raw body, or None when not computed).
+    """
     now = datetime.now(timezone.utc)
     date_str = now.strftime("%Y%m%d")
     ts_str = now.strftime("%Y%m%dT%H%M%SZ")
+    ext = "csv" if fmt == "csv" else "json"
+    ct = "text/csv" if fmt == "csv" else "application/json"
+    key_stem = f"{s3_prefix.rstrip('/')}/{dataset_id}/{date_str}/{dataset_id}_{ts_str}"
+    extra_headers = {"ContentEncoding": "gzip"} if gzip_output else {}
 
-    # optional de-dupe via DDB
-    dedup_ok = True
-    if ddb_table_name:
-        table = DDB.Table(ddb_table_name)
-        # Partition key 'dataset' (string)
-        item = table.get_item(Key={"dataset": dataset_id}).get("Item")
-        if item and item.get("last_hash") == content_hash:
-            dedup_ok = False
+    dedupe = prior_hashes is not None
+    hasher = hashlib.sha256() if dedupe else None
+    key = None if dedupe else f"{key_stem}_{secrets.token_hex(6)}.{ext}"
+    metadata = {"oecd_source_url": url_used}
+    gz = None
+    spooling = True
+    raw = None  # uncompressed spool; set to None again once the body outgrows it
+    spill = None  # dedupe only: temp file holding the compressed body until the verdict
+    buf = bytearray()
+    upload = None
+    s3_checksum = None
+    try:
+        for chunk in chunks:
+            if hasher:
+                hasher.update(chunk)
+            if spooling:
+                # adopt fetch_oecd's head buffer as the spool rather than copying it
+                if raw is None:
+                    raw = chunk if isinstance(chunk, bytearray) else bytearray(chunk)
+                else:
+                    raw += chunk
+                if len(raw) < PART_SIZE:
+                    continue
+                # too big to hold uncompressed: compress from here on
+                chunk, raw, spooling = raw, None, False
+                if gzip_output:
+                    gz = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+                if dedupe:
+                    spill = tempfile.TemporaryFile()
+            if gz:
+                chunk = deflate(gz, chunk)
+            if spill is not None:
+                spill.write(chunk)
+                continue
+            if not buf and len(chunk) >= PART_SIZE:
+                part = chunk  # already a full part (e.g. the spool): send it without copying into buf
+            else:
+                if buf:
+                    buf += chunk
+                else:
+                    buf = chunk if isinstance(chunk, bytearray) else bytearray(chunk)
+                if len(buf) < PART_SIZE:
+                    continue
+                part = buf
+            chunk = None
+            if upload is None:
+                resp = S3.create_multipart_upload(Bucket=s3_bucket, Key=key, ContentType=ct,
+                                                  Metadata=metadata, **extra_headers)
+                upload = {"Bucket": s3_bucket, "Key": key, "UploadId": resp["UploadId"], "Parts": []}
+            upload_part(upload, part)
+            part = None
+            buf = bytearray()
+        if gz:
+            tail = gz.flush()
+            if spill is not None:
+                spill.write(tail)
+            else:
+                buf += tail
+        content_hash = hasher.hexdigest() if hasher else None
+
+        # optional de-dupe against the hashes prefetched from DDB
+        if dedupe and prior_hashes.get(dataset_id) == content_hash:
+            return {
+                "stored": False,
+                "reason": "unchanged",
+                "hash": content_hash,
+                "url": url_used
+            }
+
+        if dedupe:
+            key = f"{key_stem}_{content_hash[:12]}.{ext}"
+            metadata["sha256"] = content_hash
+        if spill is not None:
+            size = spill.tell()
+            spill.seek(0)
+            if size < PART_SIZE:
+                buf = spill.read()  # compressed down to a single put
+            else:
+                resp = S3.create_multipart_upload(Bucket=s3_bucket, Key=key, ContentType=ct,
+                                                  Metadata=metadata, **extra_headers)
+                upload = {"Bucket": s3_bucket, "Key": key, "UploadId": resp["UploadId"], "Parts": []}
+                while part := spill.read(PART_SIZE):
+                    upload_part(upload, part)
+                part = None
+        if upload is None:
+            if raw is not None:
+                body, extra_headers = maybe_compress(raw, gzip_output)
+            else:
+                body = buf
+            # Without dedupe there is no client-side hash: have the SDK send a SHA-256 checksum
+            # (in place of its default CRC32), which S3 verifies and echoes back.
+            checksum = {} if dedupe else {"ChecksumAlgorithm": "SHA256"}
+            resp = S3.put_object(
+                Bucket=s3_bucket,
+                Key=key,
+                Body=body,
+                ContentType=ct,
+                Metadata=metadata,
+                **checksum,
+                **extra_headers
+            )
+            if resp.get("ChecksumSHA256"):
+                # note: covers the stored bytes, i.e. the gzipped body when GZIP=true
+                s3_checksum = base64.b64decode(resp["ChecksumSHA256"]).hex()
         else:
-            table.put_item(Item={
-                "dataset": dataset_id,
-                "last_hash": content_hash,
-                "last_url": url_used,
-                "last_run": ts_str
-            })
-
-    if not dedup_ok:
-        return {
-            "stored": False,
-            "reason": "unchanged",
-            "hash": content_hash,
-            "url": url_used
-        }
+            if buf:
+                upload_part(upload, buf)
+            S3.complete_multipart_upload(Bucket=s3_bucket, Key=upload["Key"], UploadId=upload["UploadId"],
+                                         MultipartUpload={"Parts": upload["Parts"]})
+    except Exception:
+        # don't leave orphaned parts behind
+        if upload is not None:
+            S3.abort_multipart_upload(Bucket=s3_bucket, Key=upload["Key"], UploadId=upload["UploadId"])
+        raise
+    finally:
+        if spill is not None:
+            spill.close()
 
-    ext = "csv" if fmt == "csv" else "json"
-    key = f"{s3_prefix.rstrip('/')}/{dataset_id}/{date_str}/{dataset_id}_{ts_str}_{content_hash[:12]}.{ext}"
-    body, extra_headers = maybe_compress(raw, gzip_output)
-    ct = "text/csv" if fmt == "csv" else "application/json"
-    S3.put_object(
-        Bucket=s3_bucket,
-        Key=key,
-        Body=body,
-        ContentType=ct,
-        Metadata={"oecd_source_url": url_used, "sha256": content_hash},
-        **extra_headers
-    )
+    if dedupe:
+        # written in one batch by the caller once every dataset is done
+        ddb_updates.append({
+            "dataset": dataset_id,
+            "last_hash": content_hash,
+            "last_url": url_used,
+            "last_run": ts_str
+        })
     return {
         "stored": True,
         "s3_key": key,
         "hash": content_hash,
+        "s3_checksum_sha256": s3_checksum,
         "url": url_used
     }
 
@@ -150,6 +352,8 @@ def lambda_handler(event, context):
       GZIP=true          # true|false
       LAST_N_OBS=60      # last observations to fetch (60 ~ 5 years monthly)
       DEDUPE_TABLE=OECDIngestState  # optional DynamoDB table name (pk: dataset)
+      MAX_WORKERS=4      # datasets fetched concurrently (capped at MAX_POOL);
+                         # defaults to what fits in AWS_LAMBDA_FUNCTION_MEMORY_SIZE
     """
     s3_bucket = getenv("S3_BUCKET", required=True)
     s3_prefix = getenv("S3_PREFIX", "oecd/raw")
@@ -157,6 +361,8 @@ def lambda_handler(event, context):
     gzip_output = getenv("GZIP", "true").lower() == "true"
     last_n_obs = int(getenv("LAST_N_OBS", "60"))
     ddb_table = getenv("DEDUPE_TABLE", None)
+    # more workers than pooled connections would just open and discard extra sockets
+    max_workers = min(int(getenv("MAX_WORKERS", default_workers())), MAX_POOL)
 
     # dataset list
     datasets = [d.strip() for d in getenv("OECD_DATASETS", required=True).split(",") if d.strip()]
@@ -165,25 +371,51 @@ def lambda_handler(event, context):
     except json.JSONDecodeError as e:
         raise RuntimeError(f"OECD_KEYS_JSON must be valid JSON mapping: {e}")
 
-    results = []
-    for ds in datasets:
+    # As with the old per-dataset get_item, a DynamoDB failure fails the datasets, not the invocation
+    load_error = None
+    try:
+        prior_hashes = load_last_hashes(ddb_table, datasets) if ddb_table else None
+    except Exception as e:
+        load_error = f"dedupe state not loaded: {e}"
+    ddb_updates = []
+
+    def ingest(ds):
         key_path = keys_map.get(ds, "all")  # default to 'all' keys if not provided
         try:
-            raw, url_used = fetch_oecd(ds, key_path, last_n_obs, fmt)
-            out = put_if_new(ds, url_used, raw, s3_bucket, s3_prefix, fmt, gzip_output, ddb_table)
+            chunks, url_used = fetch_oecd(ds, key_path, last_n_obs, fmt)
+            out = put_if_new(ds, url_used, chunks, s3_bucket, s3_prefix, fmt, gzip_output, prior_hashes, ddb_updates)
             out["dataset"] = ds
-            results.append(out)
+            return out
+        except Exception as e:
+            return {"dataset": ds, "error": str(e)}
+
+    # Datasets are independent and the work is mostly waiting on OECD, so overlap the fetches.
+    # boto3 clients are thread-safe, so the module-level S3 client is shared by the workers.
+    if load_error:
+        results = [{"dataset": ds, "error": load_error} for ds in datasets]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(datasets)))) as pool:
+            results = list(pool.map(ingest, datasets))
+
+    # The objects are already in S3; a failed state write must not hide the per-dataset results
+    dedupe_error = None
+    if ddb_updates:
+        try:
+            save_last_hashes(ddb_table, ddb_updates)
         except Exception as e:
-            results.append({"dataset": ds, "error": str(e)})
+            dedupe_error = f"dedupe state not saved: {e}"
 
     ok = [r for r in results if r.get("stored") or r.get("reason") == "unchanged"]
     errs = [r for r in results if r.get("error")]
+    summary = {
+        "stored": sum(1 for r in ok if r.get("stored")),
+        "unchanged": sum(1 for r in ok if r.get("reason") == "unchanged"),
+        "errors": len(errs)
+    }
+    if dedupe_error:
+        summary["dedupe_error"] = dedupe_error
     return {
-        "statusCode": 200 if not errs else 207,
-        "summary": {
-            "stored": sum(1 for r in ok if r.get("stored")),
-            "unchanged": sum(1 for r in ok if r.get("reason") == "unchanged"),
-            "errors": len(errs)
-        },
+        "statusCode": 200 if not errs and not dedupe_error else 207,
+        "summary": summary,
         "results": results
     }